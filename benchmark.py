@@ -0,0 +1,109 @@
+""" Benchmarks for the NLP pipeline
+
+    Import time is measured with `python -X importtime -c "import pipeline"` in a fresh
+    interpreter, so heavy libraries (nltk, lark, majka, pydot) must not be imported
+    at module import time. Bare startup is the wall-clock time of a plain
+    `python pipeline.py <empty file> <directory>` run, it covers only the interpreter
+    and import of pipeline. Cold CLI run is the wall-clock time of a short real run
+    on CLI_DOCUMENT, which loads Majka, punkt and builds the Lark parser.
+
+    @param sys.argv[1] - Number of runs (optional, default RUNS_DEFAULT)
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+RUNS_DEFAULT = 5
+# Targets for import of pipeline.py (cumulative -X importtime value), bare startup and cold CLI run
+TARGET_IMPORT_MS = 50
+TARGET_STARTUP_MS = 150
+TARGET_CLI_MS = 2000
+
+CLI_DOCUMENT = "sentence-1.txt"
+
+HEAVY_MODULES = ["nltk", "lark", "majka", "pydot"]
+REPO_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def measure_import_time(module="pipeline"):
+    """ Return (cumulative import time of module in ms, imported heavy modules) """
+    code = "import sys, {0}; print(','.join(m for m in {1!r} if m in sys.modules))".format(
+        module, HEAVY_MODULES)
+
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=REPO_DIRECTORY,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+
+    # line format: "import time: self [us] | cumulative | imported package"
+    import_ms = None
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == module:
+            import_ms = int(parts[1]) / 1000
+
+    if import_ms is None:
+        raise RuntimeError("Module <%s> was not found in -X importtime output" % module)
+
+    heavy = [m for m in result.stdout.strip().split(",") if m]
+    return (import_ms, heavy)
+
+
+def measure_cli_run(document=None):
+    """ Return wall-clock time in ms of the pipeline CLI run on document (empty document if None) """
+    with tempfile.TemporaryDirectory() as directory:
+        if document is None:
+            document = os.path.join(directory, "empty.txt")
+            open(document, "w").close()
+
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "pipeline.py", document, directory], cwd=REPO_DIRECTORY,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                       universal_newlines=True, check=True)
+        return (time.perf_counter() - start) * 1000
+
+
+def main(runs):
+    import_times = []
+    startup_times = []
+    cli_times = []
+    heavy = []
+
+    try:
+        for _ in range(runs):
+            (import_ms, heavy) = measure_import_time()
+            import_times.append(import_ms)
+            startup_times.append(measure_cli_run())
+            cli_times.append(measure_cli_run(CLI_DOCUMENT))
+    except RuntimeError as e:
+        print("benchmark failed: %s" % e)
+        return 1
+    except subprocess.CalledProcessError as e:
+        print("benchmark failed: %s\n%s" % (e, e.stderr))
+        return 1
+
+    import_median = statistics.median(import_times)
+    startup_median = statistics.median(startup_times)
+    cli_median = statistics.median(cli_times)
+    print("import pipeline: median {:.1f} ms, min {:.1f} ms (target {} ms)".format(
+        import_median, min(import_times), TARGET_IMPORT_MS))
+    print("bare startup:    median {:.1f} ms, min {:.1f} ms (target {} ms)".format(
+        startup_median, min(startup_times), TARGET_STARTUP_MS))
+    print("cold CLI run:    median {:.1f} ms, min {:.1f} ms (target {} ms, {})".format(
+        cli_median, min(cli_times), TARGET_CLI_MS, CLI_DOCUMENT))
+
+    failed = False
+    if heavy:
+        print("heavy modules imported eagerly: %s" % ", ".join(heavy))
+        failed = True
+    if import_median > TARGET_IMPORT_MS or startup_median > TARGET_STARTUP_MS or cli_median > TARGET_CLI_MS:
+        print("target was not met")
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else RUNS_DEFAULT))
@@ -0,0 +1,181 @@
+"""
+Opt-in memory profiling for the NLP pipeline
+
+Allocations are traced by tracemalloc, so the profiling is slow and it should be
+enabled only when we are looking for the source of memory problems. For every sentence
+we record peak and retained memory of each pipeline stage, number of combinations created
+by itertools.product and size of the parse forests returned by Earley parser.
+
+Optional soft ceiling (in bytes of traced memory) allows to skip a sentence
+instead of crashing the whole process. The ceiling is checked at the beginning
+of each stage, between combinations and after each parse, a single Earley parse
+cannot be interrupted while it is running; it is stopped only by MemoryError.
+"""
+
+import logging
+import tracemalloc
+
+LOGGER = logging.getLogger('deep-nlp-pipeline:memprofile')
+
+WORST_OFFENDERS_DEFAULT = 10
+
+
+class MemoryCeilingExceeded(Exception):
+    """ Traced memory reached the soft ceiling, current sentence should be skipped """
+
+
+def forest_size(tree):
+    """ Return (number of nodes, number of ambiguous nodes) of the parse forest
+
+        Shared subtrees are counted only once.
+    """
+    nodes = 0
+    ambiguities = 0
+    visited = set()
+    stack = [tree]
+
+    while stack:
+        node = stack.pop()
+        if id(node) in visited:
+            continue
+        visited.add(id(node))
+        nodes += 1
+        children = getattr(node, 'children', None)
+        if children is None:
+            continue
+        if node.data == '_ambig':
+            ambiguities += 1
+        stack.extend(children)
+
+    return (nodes, ambiguities)
+
+
+class MemoryProfiler:
+    """ Record memory used by pipeline stages for each sentence
+
+        Disabled profiler does nothing, so it can be always passed to the pipeline.
+        Stages are sequential, starting a new stage ends the previous one. Tracing
+        is started by a ceiling or on the first use if start() was not called.
+    """
+
+    def __init__(self, enabled=False, ceiling=None):
+        self.enabled = enabled or ceiling is not None
+        self.ceiling = ceiling
+        self.sentences = {}
+        self.forests = []
+        self.skipped = []
+
+        self._sentence = None
+        self._stage = None
+        self._stage_start = 0
+
+        if ceiling is not None:
+            # ceiling cannot be enforced without tracing
+            self.start()
+
+    def start(self):
+        if self.enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stop(self):
+        self.end_sentence()
+        if self.enabled and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def begin_sentence(self, counter, text):
+        if not self.enabled:
+            return
+        self.start()
+        self.end_sentence()
+        self._sentence = counter
+        self.sentences[counter] = {
+            'text': text,
+            'stages': {},
+            'combinations': 0,
+        }
+
+    def end_sentence(self):
+        if not self.enabled:
+            return
+        self._end_stage()
+        self._sentence = None
+
+    def stage(self, name):
+        """ End current stage of the sentence and begin a new one
+
+            Raise MemoryCeilingExceeded if traced memory reached the soft ceiling
+        """
+        if not self.enabled or self._sentence is None:
+            return
+        self._end_stage()
+        self.check_ceiling()
+        self._stage = name
+        tracemalloc.reset_peak()
+        (self._stage_start, _) = tracemalloc.get_traced_memory()
+
+    def _end_stage(self):
+        if self._stage is None:
+            return
+        (current, peak) = tracemalloc.get_traced_memory()
+        self.sentences[self._sentence]['stages'][self._stage] = {
+            'peak': peak - self._stage_start,
+            'retained': current - self._stage_start,
+        }
+        self._stage = None
+
+    def record_combinations(self, count):
+        if self.enabled and self._sentence is not None:
+            self.sentences[self._sentence]['combinations'] = count
+
+    def record_forest(self, variant, tree):
+        if not self.enabled:
+            return
+        (nodes, ambiguities) = forest_size(tree)
+        self.forests.append((nodes, ambiguities, self._sentence, variant))
+
+    def record_skip(self, reason):
+        if self.enabled:
+            self.skipped.append((self._sentence, reason))
+
+    def check_ceiling(self):
+        """ Raise MemoryCeilingExceeded if traced memory reached the soft ceiling """
+        if self.ceiling is None:
+            return
+        self.start()
+        (current, _) = tracemalloc.get_traced_memory()
+        if current >= self.ceiling:
+            raise MemoryCeilingExceeded(
+                'traced memory {} B reached the ceiling {} B'.format(current, self.ceiling))
+
+    def sentence_peak(self, counter):
+        return max([s['peak'] for s in self.sentences[counter]['stages'].values()] or [0])
+
+    def report(self, limit=WORST_OFFENDERS_DEFAULT):
+        """ Log the worst offenders: sentences, stages and forests """
+        if not self.enabled:
+            return
+
+        LOGGER.info("**** Memory profile: %d sentences, %d skipped",
+                    len(self.sentences), len(self.skipped))
+
+        for counter in sorted(self.sentences, key=self.sentence_peak, reverse=True)[:limit]:
+            sentence = self.sentences[counter]
+            stages = ", ".join(
+                "{}: peak {} B / retained {} B".format(name, s['peak'], s['retained'])
+                for (name, s) in sentence['stages'].items())
+            LOGGER.info("sentence %d (peak %d B, %d combinations) <%s> %s",
+                        counter, self.sentence_peak(counter), sentence['combinations'],
+                        sentence['text'], stages)
+
+        stages = [(s['peak'], name, counter)
+                  for (counter, sentence) in self.sentences.items()
+                  for (name, s) in sentence['stages'].items()]
+        for (peak, name, counter) in sorted(stages, reverse=True)[:limit]:
+            LOGGER.info("stage %s of sentence %d: peak %d B", name, counter, peak)
+
+        for (nodes, ambiguities, counter, variant) in sorted(self.forests, reverse=True)[:limit]:
+            LOGGER.info("forest of sentence %d variant %d: %d nodes, %d ambiguities",
+                        counter, variant, nodes, ambiguities)
+
+        for (counter, reason) in self.skipped:
+            LOGGER.info("sentence %d was skipped: %s", counter, reason)
@@ -2,27 +2,26 @@
 
     @param sys.argv[1] - Name of the file where first line is read and parsed
 """
+import functools
 import itertools
 import logging
+import operator
 import os
 import re
 import sys
 
-from lark import Lark, Token, Tree
-from lark import tree as larktree
-from majka import Majka
-from nltk import sent_tokenize, word_tokenize
-
+from memprofile import MemoryCeilingExceeded, MemoryProfiler
 from preprocessor import preprocessor
 
 MAJKA_WLT_PATH = "majka/majka.w-lt"
 VOCABULARY_PATH = "vocabulary.csv"
 LOGLEVEL_DEFAULT = "INFO"
+# Memory profiling is opt-in: MEMPROFILE=1 and/or soft ceiling MEMORY_CEILING_MB=<MB>
+MEMPROFILE_DEFAULT = "0"
 
 BLOCKED_LEMMA = ["dobřit"]
 BLOCKED_K1 = ["malá"]
 
-MORPH = Majka(MAJKA_WLT_PATH)
 LOGGER = logging.getLogger('deep-nlp-pipeline')
 
 RE_EMOTICONS = re.compile(u'['
@@ -66,8 +65,54 @@ GRAMMAR = """
 """
 sentence_counter = 0
 
+# Heavy resources (nltk, lark, majka) are loaded on the first use, so importing
+# this module stays cheap, e.g. for unit tests
+_MORPH = None
+_PARSER = None
+_TREE_TO_PNG = None
+
+
+def get_morph():
+    """ Return Majka morphological analyzer, dictionary is loaded on the first call """
+    global _MORPH
+
+    if _MORPH is None:
+        from majka import Majka
+        _MORPH = Majka(MAJKA_WLT_PATH)
+    return _MORPH
+
+
+def get_parser():
+    """ Return Earley parser for GRAMMAR, parser is built on the first call """
+    global _PARSER
+
+    if _PARSER is None:
+        from lark import Lark
+        _PARSER = Lark(preprocessor(GRAMMAR, load_semtypes_from_vocabulary()), parser='earley', start='sentence',
+                       debug=True, ambiguity='explicit')
+    return _PARSER
+
+
+def get_tree_to_png():
+    """ Return lark function rendering tree to PNG, lark.tree (and pydot) is imported on the first call """
+    global _TREE_TO_PNG
+
+    if _TREE_TO_PNG is None:
+        from lark import tree as larktree
+        _TREE_TO_PNG = larktree.pydot__tree_to_png
+    return _TREE_TO_PNG
+
+
+def get_tokenizers():
+    """ Return nltk (sent_tokenize, word_tokenize), punkt is loaded and cached by nltk on the first use """
+    from nltk import sent_tokenize, word_tokenize
+    return (sent_tokenize, word_tokenize)
+
 
 def get_tokens_from_tree(tree):
+    # tree is a result of lark parser, so lark is already imported
+    from lark import Token, Tree
+
     output = []
     if isinstance(tree, Token):
         output.append(tree.value)
@@ -83,14 +128,19 @@ def get_tokens_from_tree(tree):
     return output
 
 
-def run_earley_parser(sentence, word_sentence, counter, variant, label, directory):
+def run_earley_parser(sentence, word_sentence, counter, variant, label, directory, profiler=None):
     if '#unknown' in sentence:
         # Unknown token cannot be resolved into valid tree
         return None
 
+    parser = get_parser()
     try:
         sentence_wo_floskule = [x for x in sentence if x != "#floskule"]
-        parse_tree = PARSER.parse(" ".join(sentence_wo_floskule))
+        parse_tree = parser.parse(" ".join(sentence_wo_floskule))
+        if profiler is not None:
+            profiler.record_forest(variant, parse_tree)
+            # single explicit-ambiguity forest can be huge, do not render or keep it
+            profiler.check_ceiling()
 #        print(sentence)
 #        print(parse_tree.pretty())
 
@@ -107,11 +157,14 @@ def run_earley_parser(sentence, word_sentence, counter, variant, label, director
 
         print(expanded_sentence)
 
-        larktree.pydot__tree_to_png(
+        get_tree_to_png()(
             parse_tree, directory + '/sentence-{:03d}-{:02d}.png'.format(counter, variant), label=label + "\n" + " ".join(sentence))
         with open(directory + "/sentence-{:03d}-{:02d}.pretty".format(counter, variant), "w") as f:
             f.write(parse_tree.pretty())
 
+    except (MemoryCeilingExceeded, MemoryError):
+        # memory problems are handled per sentence by parse_document()
+        raise
     except Exception as e:
         LOGGER.info(e)
         LOGGER.info("Unable to create a tree for <%s>", (" ".join(sentence)))
@@ -219,13 +272,21 @@ def local_blocklist(analyses):
     return result
 
 
-def parse_document(text, output_directory):
+def parse_document(text, output_directory, profiler=None):
     """ Parse document and show results on standard output
 
         @param text - Document (several sentences) to parse
+        @param profiler - MemoryProfiler recording memory used by each sentence (optional)
     """
     global sentence_counter
 
+    (sent_tokenize, word_tokenize) = get_tokenizers()
+
+    if profiler is None:
+        profiler = MemoryProfiler()
+    # build resources before the first sentence so they are not counted in its memory profile
+    morph = get_morph()
+    get_parser()
     vocabulary = load_vocabulary()
 
     # get sentences
@@ -243,81 +304,99 @@ def parse_document(text, output_directory):
         sentence_without_emoticons = sentence_without_emoticons.replace(
             ';)', '')
         sentence_counter += 1
-
-        for word in word_tokenize(sentence_without_emoticons):
-            res = MORPH.find(word) + local_morph(word)
-
-            if res == []:
-                valid_sentence = False
-                LOGGER.debug('Unknown token detected "%s"', word)
-
-            if res:
-                for candidate in res:
-                    if candidate['tags'] == {} and candidate['lemma'] != 's':
-                        valid_sentence = False
-                        LOGGER.debug(
-                            'Token "%s" was recognized but it has no tags at all', word)
-            res = local_blocklist(res)
-            for analyse in res:
-                analyse['semtype'] = add_semtypes_for_lemma(
-                    vocabulary, analyse['lemma'], analyse['tags'])
-
-            # Check if all analyses of the word are verbs (ignoring for now)
-            contain_verb = all(
-                [analyse.get('tags', {}).get('pos', '') == 'verb'
-                 for analyse in res])
-
-            # unpack semtypes from string to multiple elements
-            unpack_res = []
-            for analyse in res:
-                if analyse['semtype']:
-                    for semtype in analyse['semtype']:
+        profiler.begin_sentence(sentence_counter, sentence)
+        try:
+            profiler.stage('morphology')
+
+            for word in word_tokenize(sentence_without_emoticons):
+                res = morph.find(word) + local_morph(word)
+
+                if res == []:
+                    valid_sentence = False
+                    LOGGER.debug('Unknown token detected "%s"', word)
+
+                if res:
+                    for candidate in res:
+                        if candidate['tags'] == {} and candidate['lemma'] != 's':
+                            valid_sentence = False
+                            LOGGER.debug(
+                                'Token "%s" was recognized but it has no tags at all', word)
+                res = local_blocklist(res)
+                for analyse in res:
+                    analyse['semtype'] = add_semtypes_for_lemma(
+                        vocabulary, analyse['lemma'], analyse['tags'])
+
+                # Check if all analyses of the word are verbs (ignoring for now)
+                contain_verb = all(
+                    [analyse.get('tags', {}).get('pos', '') == 'verb'
+                     for analyse in res])
+
+                # unpack semtypes from string to multiple elements
+                unpack_res = []
+                for analyse in res:
+                    if analyse['semtype']:
+                        for semtype in analyse['semtype']:
+                            new_analyses = dict(analyse)
+                            new_analyses['semtype'] = semtype
+                            unpack_res.append(new_analyses)
+                    else:
                         new_analyses = dict(analyse)
-                        new_analyses['semtype'] = semtype
                         unpack_res.append(new_analyses)
-                else:
-                    new_analyses = dict(analyse)
-                    unpack_res.append(new_analyses)
-
-            tokens.append(unpack_res)
-
-        if not contain_verb and valid_sentence and tokens:
-            new_sentence = []
-            for token in tokens:
-                token_analysis = []
-                for analysis in token:
-                    base_form = analysis['semtype'] if analysis['semtype'] else analysis.get(
-                        'lemma')
-                    token_analysis.append(base_form)
-                new_sentence.append(list(set(token_analysis)))
-
-            # remove trailing punctuation
-            if new_sentence[-1] in [["."], ["!"], ["..."]]:
-                new_sentence.pop()
-
-            cfg_sentence = []
-            for token_analysis in new_sentence:
-                cfg_sentence.append(list(set([normalize_sem_token(token)
-                                              for token in token_analysis])))
-
-            if ["#unknown"] in cfg_sentence:
-                # sentences that cannot be desambiguated because at least one word is completely unknown
-                LOGGER.error(new_sentence)
-                continue
-
-            # create all combinations that we have to parse
-            words = word_tokenize(sentence_without_emoticons)
-
-            variant = 1
-            LOGGER.debug(
-                'Semantic types for every word in the sentence: "%s"', cfg_sentence)
-            for c in itertools.product(*cfg_sentence):
-                if c:
-                    success = run_earley_parser(c, words, sentence_counter, variant,
-                                                sentence_without_emoticons, output_directory)
-                    if success:
-                        variant += 1
-                        success_combinations.append(c)
+
+                tokens.append(unpack_res)
+
+            if not contain_verb and valid_sentence and tokens:
+                profiler.stage('combinations')
+                new_sentence = []
+                for token in tokens:
+                    token_analysis = []
+                    for analysis in token:
+                        base_form = analysis['semtype'] if analysis['semtype'] else analysis.get(
+                            'lemma')
+                        token_analysis.append(base_form)
+                    new_sentence.append(list(set(token_analysis)))
+
+                # remove trailing punctuation
+                if new_sentence[-1] in [["."], ["!"], ["..."]]:
+                    new_sentence.pop()
+
+                cfg_sentence = []
+                for token_analysis in new_sentence:
+                    cfg_sentence.append(list(set([normalize_sem_token(token)
+                                                  for token in token_analysis])))
+
+                if ["#unknown"] in cfg_sentence:
+                    # sentences that cannot be desambiguated because at least one word is completely unknown
+                    LOGGER.error(new_sentence)
+                    profiler.end_sentence()
+                    continue
+
+                # create all combinations that we have to parse
+                words = word_tokenize(sentence_without_emoticons)
+
+                variant = 1
+                LOGGER.debug(
+                    'Semantic types for every word in the sentence: "%s"', cfg_sentence)
+                profiler.record_combinations(
+                    functools.reduce(operator.mul, [len(t) for t in cfg_sentence], 1))
+                profiler.stage('parse')
+                for c in itertools.product(*cfg_sentence):
+                    profiler.check_ceiling()
+                    if c:
+                        success = run_earley_parser(c, words, sentence_counter, variant,
+                                                    sentence_without_emoticons, output_directory, profiler)
+                        if success:
+                            variant += 1
+                            success_combinations.append(c)
+        except (MemoryCeilingExceeded, MemoryError) as e:
+            reason = str(e) or 'out of memory'
+            LOGGER.warning('Sentence %d was skipped (%s): "%s"',
+                           sentence_counter, reason, sentence)
+            profiler.record_skip(reason)
+            profiler.end_sentence()
+            continue
+
+        profiler.end_sentence()
 
         if not success_combinations:
             LOGGER.warning(
@@ -329,9 +408,14 @@ def parse_document(text, output_directory):
 if __name__ == "__main__":
     logging.basicConfig(level=os.environ.get("LOGLEVEL", LOGLEVEL_DEFAULT))
 
-    PARSER = Lark(preprocessor(GRAMMAR, load_semtypes_from_vocabulary()), parser='earley', start='sentence',
-                  debug=True, ambiguity='explicit')
+    ceiling_mb = os.environ.get("MEMORY_CEILING_MB")
+    profiler = MemoryProfiler(enabled=os.environ.get("MEMPROFILE", MEMPROFILE_DEFAULT) == "1",
+                              ceiling=int(float(ceiling_mb) * 1024 * 1024) if ceiling_mb else None)
+    profiler.start()
 
     with open(sys.argv[1], 'r', encoding='utf-8') as fh:
         for input_line in fh.readlines():
-            parse_document(input_line, sys.argv[2])
+            parse_document(input_line, sys.argv[2], profiler)
+
+    profiler.stop()
+    profiler.report()
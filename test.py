@@ -1,6 +1,13 @@
+import os
+import subprocess
+import sys
+import tracemalloc
 import unittest
+from unittest import mock
 
-from pipeline import add_semtypes_for_lemma
+from memprofile import MemoryCeilingExceeded, MemoryProfiler, forest_size
+import pipeline
+from pipeline import add_semtypes_for_lemma, parse_document, run_earley_parser
 from preprocessor import preprocessor
 
 
@@ -36,6 +43,161 @@ class TestAddSemtypeForLemma(unittest.TestCase):
         )
 
 
+class FakeTree:
+    def __init__(self, data, children):
+        self.data = data
+        self.children = children
+
+
+class TestLazyImport(unittest.TestCase):
+    def test_heavy_modules_are_not_imported(self):
+        """ Test if importing pipeline does not load nltk, lark, majka or pydot """
+        code = "import sys, pipeline; print(sorted(m for m in ['nltk', 'lark', 'majka', 'pydot'] if m in sys.modules))"
+        output = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+        self.assertEqual(output.strip(), '[]')
+
+
+class TestMemoryProfiler(unittest.TestCase):
+    def test_forest_size(self):
+        tree = FakeTree('sentence', [FakeTree('_ambig', [FakeTree('a', ['#foo']), FakeTree('b', ['#bar'])])])
+        self.assertEqual(forest_size(tree), (6, 1))
+
+    def test_forest_size_with_shared_subtrees(self):
+        shared = FakeTree('a', ['#foo'])
+        tree = FakeTree('_ambig', [FakeTree('b', [shared]), FakeTree('c', [shared])])
+        self.assertEqual(forest_size(tree), (5, 1))
+
+    def test_stages_are_recorded(self):
+        profiler = MemoryProfiler(enabled=True)
+        profiler.start()
+        profiler.begin_sentence(1, 'foo')
+        profiler.stage('morphology')
+        data = [0] * 100000
+        profiler.stage('parse')
+        profiler.stop()
+
+        stages = profiler.sentences[1]['stages']
+        self.assertEqual(list(stages), ['morphology', 'parse'])
+        self.assertGreater(stages['morphology']['retained'], 0)
+        self.assertGreaterEqual(profiler.sentence_peak(1), stages['morphology']['peak'])
+        del data
+
+    def test_ceiling(self):
+        profiler = MemoryProfiler(ceiling=0)
+        profiler.start()
+        data = [0] * 1000
+        self.assertRaises(MemoryCeilingExceeded, profiler.check_ceiling)
+        profiler.stop()
+        del data
+
+    def test_ceiling_without_start(self):
+        """ Test if the ceiling starts tracing itself when start() was not called """
+        self.assertFalse(tracemalloc.is_tracing())
+        profiler = MemoryProfiler(ceiling=0)
+        self.addCleanup(profiler.stop)
+
+        data = [0] * 1000
+        self.assertRaises(MemoryCeilingExceeded, profiler.check_ceiling)
+        del data
+
+    def test_ceiling_is_checked_at_stage(self):
+        profiler = MemoryProfiler(ceiling=0)
+        self.addCleanup(profiler.stop)
+        profiler.begin_sentence(1, 'foo')
+        data = [0] * 1000
+        self.assertRaises(MemoryCeilingExceeded, profiler.stage, 'morphology')
+        del data
+
+    def test_disabled_profiler_does_nothing(self):
+        profiler = MemoryProfiler()
+        profiler.start()
+        profiler.begin_sentence(1, 'foo')
+        profiler.stage('morphology')
+        profiler.check_ceiling()
+        profiler.stop()
+        self.assertEqual(profiler.sentences, {})
+
+
+class FakeMorph:
+    def find(self, word):
+        return [{'lemma': word, 'tags': {'pos': 'noun'}}, {'lemma': word + '2', 'tags': {'pos': 'noun'}}]
+
+
+class TestMemoryProfilerInPipeline(unittest.TestCase):
+    vocabulary = {'foo': {'#foo'}, 'foo2': {'#bar'}, 'bar': {'#bar'}, 'bar2': {'#foo'}}
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(pipeline, 'sentence_counter', 0),
+            mock.patch.object(pipeline, 'get_tokenizers',
+                              return_value=(lambda text, language: text.split('|'), lambda text: text.split())),
+            mock.patch.object(pipeline, 'get_morph', return_value=FakeMorph()),
+            mock.patch.object(pipeline, 'get_parser'),
+            mock.patch.object(pipeline, 'get_tree_to_png'),
+            mock.patch.object(pipeline, 'load_vocabulary', return_value=self.vocabulary),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.profiler = MemoryProfiler(enabled=True)
+        self.profiler.start()
+        self.addCleanup(self.profiler.stop)
+
+    def _parse_with_failing_first_sentence(self, error):
+        with mock.patch.object(pipeline, 'run_earley_parser', side_effect=[error] + [True] * 4) as parser:
+            with self.assertLogs('deep-nlp-pipeline', level='WARNING'):
+                parse_document('foo foo|bar', '/nonexistent', self.profiler)
+        return parser
+
+    def test_memory_error_skips_sentence(self):
+        parser = self._parse_with_failing_first_sentence(MemoryError())
+
+        self.assertEqual(self.profiler.skipped, [(1, 'out of memory')])
+        # second sentence is still parsed
+        self.assertEqual(parser.call_count, 3)
+        self.assertEqual(self.profiler.sentences[1]['combinations'], 4)
+        self.assertEqual(self.profiler.sentences[2]['combinations'], 2)
+        self.assertEqual(list(self.profiler.sentences[1]['stages']), ['morphology', 'combinations', 'parse'])
+        self.assertEqual(list(self.profiler.sentences[2]['stages']), ['morphology', 'combinations', 'parse'])
+
+    def test_ceiling_skips_sentence(self):
+        self._parse_with_failing_first_sentence(MemoryCeilingExceeded('above ceiling'))
+
+        self.assertEqual(self.profiler.skipped, [(1, 'above ceiling')])
+        self.assertIn(2, self.profiler.sentences)
+
+    def test_memory_error_in_morphology_skips_sentence(self):
+        morph = FakeMorph()
+        morph.find = mock.Mock(side_effect=[MemoryError()] + [FakeMorph().find('bar')])
+        with mock.patch.object(pipeline, 'get_morph', return_value=morph), \
+                mock.patch.object(pipeline, 'run_earley_parser', return_value=True) as parser:
+            with self.assertLogs('deep-nlp-pipeline', level='WARNING'):
+                parse_document('foo foo|bar', '/nonexistent', self.profiler)
+
+        self.assertEqual(self.profiler.skipped, [(1, 'out of memory')])
+        self.assertEqual(list(self.profiler.sentences[1]['stages']), ['morphology'])
+        # second sentence is still parsed
+        self.assertEqual(parser.call_count, 2)
+
+    def test_parser_memory_error_is_propagated(self):
+        pipeline.get_parser.return_value.parse.side_effect = MemoryError()
+        self.assertRaises(MemoryError, run_earley_parser, ('#foo',), ['foo'], 1, 1, 'foo', '/nonexistent',
+                          self.profiler)
+
+    def test_ceiling_is_checked_after_parse(self):
+        pipeline.get_parser.return_value.parse.return_value = FakeTree('sentence', ['#foo'])
+        profiler = MemoryProfiler(ceiling=0)
+        profiler.start()
+        self.addCleanup(profiler.stop)
+
+        self.assertRaises(MemoryCeilingExceeded, run_earley_parser, ('#foo',), ['foo'], 1, 1, 'foo',
+                          '/nonexistent', profiler)
+        self.assertEqual(len(profiler.forests), 1)
+        pipeline.get_tree_to_png.assert_not_called()
+
+
 class TestPreprocessor(unittest.TestCase):
     # @todo: create own assertEqual that will call preprocessor and adds self.permanent_suffix
     permanent_suffix = '\nempty:\n%ignore " "'